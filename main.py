@@ -2,21 +2,55 @@ import asyncio
 import os
 import random
 import re
-import time
 import json
 import logging
-import requests
-from playwright.async_api import async_playwright
+from collections import defaultdict
+import httpx
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 from supabase import create_client, Client
 from bs4 import BeautifulSoup
-from datetime import datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # --- CONFIGURATION ---
+def env_int(name, default, floor=0):
+    """Integer env setting; blank or malformed values fall back to the default."""
+    try: value = int(os.environ.get(name) or default)
+    except ValueError: value = default
+    return max(floor, value)
+
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
-CONCURRENCY = 3 
+CONCURRENCY = env_int("CONCURRENCY", 3, floor=1)  # pages open at once
+HOST_CONCURRENCY = 1  # pages open per host at once
+HOST_INTERVAL = 1.0  # min gap (s) between checks on one host
+HOST_JITTER = 0.5  # max random delay (s) before each hit
+WRITE_CHUNK = 500  # rows per bulk upsert/insert
+READ_PAGE = 1000  # rows asked for per patrol-list page (server may cap lower)
+NAV_TIMEOUT = 15000  # ms to DOMContentLoaded before a page is given up
+BODY_TEXT_LIMIT = 16000  # chars of rendered text the price court scans
+HTTP_CONCURRENCY = 10  # plain-HTTP pre-checks (HEAD / static GET) in flight at once
+PATROL_LIMIT = env_int("PATROL_LIMIT", 0)  # 0 = every source
+SKIP_MAX_AGE = 6 * 3600  # s a 304 may keep skipping a page before a full re-scrape
+
+# Optional on-disk Chromium profile (warm HTTP cache + cookies across patrols)
+BROWSER_PROFILE_DIR = os.environ.get("BROWSER_PROFILE_DIR")
+PROFILE_CACHE_BYTES = 100 * 1024 * 1024  # HTTP cache cap, keeps the saved profile small
+# Optional long-lived Chromium to attach to (e.g. http://localhost:9222)
+BROWSER_CDP_URL = os.environ.get("BROWSER_CDP_URL")
 
 # Logging
 logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -28,21 +62,61 @@ if not all([SUPABASE_URL, SUPABASE_KEY, GEMINI_API_KEY]):
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# Shared keep-alive client for cheap HTTP pre-checks. The gate keeps the
+# pool from queueing, so the pool timeout only trips on a real leak.
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(10, pool=30), follow_redirects=True,
+    limits=httpx.Limits(max_connections=HTTP_CONCURRENCY)
+)
+
+async def run_db(query):
+    """Executes a (blocking) Supabase query on a worker thread."""
+    return await asyncio.to_thread(query.execute)
+
 USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36"
 ]
 
+# Only text/DOM is consumed, so these never need to hit the wire.
+# Stylesheets stay: innerText relies on CSS visibility.
+BLOCKED_RESOURCES = {"image", "media", "font"}
+# Third-party trackers/ads: never carry product data, only slow the load
+BLOCKED_HOSTS = (
+    "google-analytics.com", "googletagmanager.com", "doubleclick.net",
+    "facebook.net", "hotjar.com", "clarity.ms", "tiktok.com", "criteo.com"
+)
+
+# True once real price content has rendered: a JSON-LD block with offers,
+# a price meta tag / itemprop, or a price-classed element showing a "$" amount.
+# Bare placeholders, site-wide JSON-LD and "price-match" nav links don't count.
+PRICE_READY_JS = """() => {
+    for (const s of document.querySelectorAll('script[type="application/ld+json"]'))
+        if (s.textContent.includes('"offers"')) return true;
+    if (document.querySelector('meta[property="og:price:amount"], '
+        + 'meta[property="product:price:amount"], [itemprop="price"]')) return true;
+    for (const el of document.querySelectorAll('[class*="price"], [data-price]'))
+        if (/\\$\\s?[0-9]/.test(el.textContent)) return true;
+    return false;
+}"""
+
 BANNED_PHRASES = [
     "login", "password", "cart", "checkout", "loading", "rights reserved", 
     "privacy policy", "terms", "newsletter", "shipping", "click here"
 ]
 
+# Compiled once at import: these run over every page's text
+WHITESPACE_RE = re.compile(r'\s+')
+# "$" amount split into whole part and optional ".decimals" (see scan_prices)
+PRICE_RE = re.compile(r'\$\s?([0-9,]+)(\.[0-9]*)?')
+# One alternation scans for every banned phrase in a single pass
+BANNED_RE = re.compile('|'.join(map(re.escape, BANNED_PHRASES)))
+
 # --- 1. INTELLIGENT PARSERS ---
 
 def clean_text(text):
     if not text: return None
-    return re.sub(r'\s+', ' ', text).strip()
+    return WHITESPACE_RE.sub(' ', text).strip()
 
 def validate_description(text, title):
     if not text: return None
@@ -50,7 +124,7 @@ def validate_description(text, title):
     low = clean.lower()
     
     if len(clean) < 50: return None
-    if any(b in low for b in BANNED_PHRASES): return None
+    if BANNED_RE.search(low): return None
     # Reject if it's just the title repeated
     if title and title.lower() in low and len(clean) < len(title) + 20: return None
     
@@ -64,7 +138,8 @@ def extract_json_ld(soup):
         try:
             content = script.string
             if not content: continue
-            js = json.loads(content)
+            # str(): bs4 hands back a str subclass, which orjson rejects
+            js = json_loads(str(content))
             items = js if isinstance(js, list) else [js]
             
             for item in items:
@@ -92,17 +167,21 @@ def extract_json_ld(soup):
         except: continue
     return data
 
-# --- 2. PRICE COURT (The Fixing Engine) ---
+def scan_prices(text):
+    """Single pass over the text for every "$" amount.
 
-def get_price_verdict(soup, json_price, body_text):
-    candidates = []
+    Yields (raw, cents): raw is the full amount ("1,234.5"), cents is the
+    amount cut to two decimals ("1,234.56") when at least two follow, else None.
+    """
+    for m in PRICE_RE.finditer(text):
+        whole, frac = m.group(1), m.group(2) or ""
+        yield whole + frac, (whole + frac[:3] if len(frac) >= 3 else None)
 
-    # Source 1: JSON-LD (High Trust: 10)
-    if json_price:
-        candidates.append({"src": "JSON", "val": json_price, "trust": 10})
+# --- 2. PRICE COURT (The Fixing Engine) ---
 
-    # Source 2: Meta Tags (Medium Trust: 8)
-    # These are usually correct ($369)
+def get_meta_prices(soup):
+    """Reads the price meta tags (og / product / itemprop)."""
+    prices = []
     metas = [
         soup.find("meta", property="og:price:amount"),
         soup.find("meta", property="product:price:amount"),
@@ -110,49 +189,76 @@ def get_price_verdict(soup, json_price, body_text):
     ]
     for m in metas:
         if m:
-            try:
-                val = float(m.get("content"))
-                candidates.append({"src": "Meta", "val": val, "trust": 8})
+            try: prices.append(float(m.get("content")))
             except: pass
+    return prices
+
+def get_fast_verdict(json_price, meta_prices, json_complete=False):
+    """Settles the price from structured data alone, or returns None."""
+    # JSON-LD and a Meta tag agree (Trust 18): settle without the body text.
+    # The full court could still be outvoted here by four or more matching
+    # Visual hits (6 each); trusting the agreed structured price is deliberate.
+    if json_price and json_price in meta_prices:
+        logger.info(f"   ⚖️ Price Court: JSON + Meta agree -> WINNER: ${json_price}")
+        return json_price
+    # A complete JSON-LD Product (price + real description) with no
+    # conflicting Meta tag is a well-formed shop page: trust it as is
+    if json_price and json_complete and not meta_prices:
+        logger.info(f"   ⚖️ Price Court: Complete JSON-LD -> WINNER: ${json_price}")
+        return json_price
+    return None
+
+def get_price_verdict(json_price, meta_prices, body_text):
+    candidates = []
 
-    # Source 3: Visual Price (Medium Trust: 6)
-    # Looks for simple distinct price strings like "$369.00"
-    # Helps confirm the Meta tag
-    visual_matches = re.findall(r'\$\s?([0-9,]+\.[0-9]{2})', body_text)
-    for m in visual_matches:
-        try:
-            v = float(m.replace(',', ''))
-            if 15 < v < 10000:
-                candidates.append({"src": "Visual", "val": v, "trust": 6})
-        except: pass
+    # Source 1: JSON-LD (High Trust: 10)
+    if json_price:
+        candidates.append({"src": "JSON", "val": json_price, "trust": 10})
 
-    # Source 4: Regex Max (Low Trust: 2)
-    # This is the "Fallback of Last Resort". We demote its trust so it can't beat Meta.
-    matches = re.findall(r'\$\s?([0-9,]+\.?[0-9]*)', body_text)
-    regex_prices = []
-    for m in matches:
+    # Source 2: Meta Tags (Medium Trust: 8)
+    # These are usually correct ($369)
+    for val in meta_prices:
+        candidates.append({"src": "Meta", "val": val, "trust": 8})
+
+    # Sources 3 + 4 share a single scan of the body text
+    regex_max = None
+    for raw, cents in scan_prices(body_text):
+        # Source 3: Visual Price (Medium Trust: 6)
+        # Looks for simple distinct price strings like "$369.00"
+        # Helps confirm the Meta tag
+        if cents:
+            try:
+                v = float(cents.replace(',', ''))
+                if 15 < v < 10000:
+                    candidates.append({"src": "Visual", "val": v, "trust": 6})
+            except: pass
+
+        # Source 4: Regex Max (Low Trust: 2)
+        # This is the "Fallback of Last Resort". We demote its trust so it can't beat Meta.
         try:
-            v = float(m.replace(',', ''))
-            if 15 < v < 50000: regex_prices.append(v)
+            v = float(raw.replace(',', ''))
+            if 15 < v < 50000 and (regex_max is None or v > regex_max): regex_max = v
         except: pass
     
-    if regex_prices:
+    if regex_max is not None:
         # We add MAX, but with LOW TRUST (2).
         # This prevents "Win $1000" (Trust 2) from beating "Price $369" (Trust 8)
-        candidates.append({"src": "RegexMax", "val": max(regex_prices), "trust": 2})
+        candidates.append({"src": "RegexMax", "val": regex_max, "trust": 2})
 
     # --- THE VERDICT ---
     if not candidates: return None
 
-    # Group by value to find consensus
+    # Group by value to find consensus, tracking the leader as we go
     # If "$369" appears in Meta AND Visual, it gets a score boost
-    votes = {}
-    for c in candidates:
+    votes, first_seen = {}, {}
+    winner_price, best = None, 0
+    for i, c in enumerate(candidates):
         val = c['val']
-        votes[val] = votes.get(val, 0) + c['trust']
-
-    # Pick the price with the highest score
-    winner_price = max(votes, key=votes.get)
+        score = votes[val] = votes.get(val, 0) + c['trust']
+        first_seen.setdefault(val, i)
+        # Ties go to the price that entered the court first
+        if score > best or (score == best and first_seen[val] < first_seen[winner_price]):
+            winner_price, best = val, score
     
     # Log the court proceedings
     log_str = " | ".join([f"{c['src']}: ${c['val']}" for c in candidates])
@@ -189,111 +295,404 @@ def get_best_description(soup, title, json_desc):
             if val: return val
 
     # 4. Paragraph Fallback
+    # Longest valid paragraph wins, but a clearly real one ends the hunt early
     best_p = ""
     for p in soup.find_all('p'):
         text = p.get_text().strip()
-        if len(text) > len(best_p):
-            if validate_description(text, title):
-                best_p = text
+        # Raw length only bounds the cleaned one from above: a cheap pre-skip
+        if len(text) < 50 or len(text) <= len(best_p): continue
+        val = validate_description(text, title)
+        if not val or len(val) <= len(best_p): continue
+        if len(val) >= 300: return val
+        best_p = val
                 
     return best_p if best_p else "Description unavailable."
 
 # --- 4. CORE WORKER ---
 
-async def process_product(sem, browser, row):
-    async with sem:
-        url = row['url']
-        pid = row['product_id']
-        source_id = row['id']
-        logger.info(f"🔎 Checking: {url}")
-
-        # --- AUTO-LINKER ---
-        if pid is None or pid == "None":
-            try:
-                new_prod = supabase.table("products").insert({
-                    "name": "Scanning...",
-                    "is_approved": False,
-                    "category": "Uncategorized" 
-                }).execute()
-                pid = new_prod.data[0]['id']
-                supabase.table("product_sources").update({"product_id": pid}).eq("id", source_id).execute()
-            except Exception as e:
-                logger.error(f"   ❌ DB Fix Failed: {e}")
-                return
+HOST_GATES = defaultdict(lambda: asyncio.Semaphore(HOST_CONCURRENCY))
+HOST_LAST_HIT = {}  # host -> loop time its last check finished
+HTTP_GATE = asyncio.Semaphore(HTTP_CONCURRENCY)
+JS_HOSTS = set()  # hosts whose plain HTML couldn't settle a price
+
+def is_tracker(url):
+    """True when the URL's host is (a subdomain of) a BLOCKED_HOSTS entry."""
+    host = urlparse(url).hostname or ""
+    return any(host == h or host.endswith("." + h) for h in BLOCKED_HOSTS)
+
+async def block_heavy_assets(route):
+    req = route.request
+    # Documents always load: the page itself may come via a tracker redirect
+    if req.resource_type in BLOCKED_RESOURCES or (
+        req.resource_type != "document" and is_tracker(req.url)
+    ):
+        await route.abort()
+    else:
+        await route.continue_()
+
+def scrape_age(row):
+    """Seconds since the source was last fully scraped (inf when unknown)."""
+    try:
+        then = datetime.fromisoformat(row['last_scraped'])
+        if then.tzinfo is None: then = then.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - then).total_seconds()
+    except Exception: return float('inf')
+
+async def is_unchanged(rows):
+    """Conditional HEAD: True when the server confirms the page is unchanged."""
+    first = rows[0]
+    validators = (first.get('last_etag'), first.get('last_modified'))
+    for r in rows:
+        if r.get('last_price') is None: return False
+        if (r.get('last_etag'), r.get('last_modified')) != validators: return False
+        # A 304 only vouches for so long: force a full scrape every SKIP_MAX_AGE
+        if scrape_age(r) > SKIP_MAX_AGE: return False
+
+    headers = {"User-Agent": random.choice(USER_AGENTS)}
+    if validators[0]: headers['If-None-Match'] = validators[0]
+    if validators[1]: headers['If-Modified-Since'] = validators[1]
+    if len(headers) == 1: return False
+
+    try:
+        async with HTTP_GATE: r = await http_client.head(first['url'], headers=headers)
+        return r.status_code == 304
+    except Exception: return False
+
+def build_source_write(row, pid, price, etag=None, modified=None, scraped="now()"):
+    write = {
+        "id": row['id'], "url": row['url'], "product_id": pid,
+        "last_price": price, "last_checked": "now()"
+    }
+    # Validator columns are optional: only track them where the table has them
+    if 'last_etag' in row: write['last_etag'] = etag
+    if 'last_modified' in row: write['last_modified'] = modified
+    if 'last_scraped' in row: write['last_scraped'] = scraped
+    return write
+
+def mark_checked(row):
+    """Source write that only records the visit; stored price and validators stay."""
+    return build_source_write(
+        row, row['product_id'], row.get('last_price'), row.get('last_etag'),
+        row.get('last_modified'), row.get('last_scraped')
+    )
+
+def is_same(old, new):
+    """Stored vs scraped value, comparing prices to the cent."""
+    if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+        return abs(old - new) < 0.005
+    return old == new
+
+def build_writes(row, data):
+    """Turns one page's scraped data into the queued writes for a source row."""
+    # Bulk upserts need identical keys on every row, so missing
+    # fields fall back to what is already stored.
+    old = row.get('products') or {}
+    pid = row['product_id']
+    price = data['price']
+    product = {
+        "name": (data['name'] or "Unknown")[:255],
+        "description": data['description'],
+        "image_url": data['image_url'] or old.get('image_url'),
+        "price": price or old.get('price')
+    }
+
+    result = {}
+    # Skip no-op rewrites: only touch the product when a field actually moved
+    if any(not is_same(old.get(k), v) for k, v in product.items()):
+        result['product'] = {"id": pid, **product, "updated_at": datetime.now().isoformat()}
+
+    if price:
+        result['source'] = build_source_write(row, pid, price, data['etag'], data['last_modified'])
+        # History records changes, not every observation
+        if not is_same(row.get('last_price'), price):
+            result['history'] = {"product_id": pid, "price": price}
+    else:
+        # No price (out of stock, layout change): record the visit only
+        result['source'] = mark_checked(row)
+    return result
+
+async def try_click(page, key):
+    try: await page.locator(f"text=/{key}/i").first.click(timeout=500)
+    except Exception: pass
+
+def extract_fields(soup):
+    """Runs every structured extractor over a parsed page."""
+    json_data = extract_json_ld(soup)
+    
+    name = json_data.get('name')
+    if not name:
+        t = soup.find("meta", property="og:title")
+        name = t.get("content") if t else soup.title.string
+
+    desc = get_best_description(soup, name, json_data.get('description'))
+
+    img_url = json_data.get('image_url')
+    if not img_url:
+        i = soup.find("meta", property="og:image")
+        img_url = i.get("content") if i else None
+
+    # Structured half of the price court; price stays None if it can't settle
+    json_price = json_data.get('price')
+    json_complete = validate_description(json_data.get('description'), name) is not None
+    meta_prices = get_meta_prices(soup)
+
+    return {
+        "name": name, "description": desc, "image_url": img_url,
+        "json_price": json_price, "meta_prices": meta_prices,
+        "price": get_fast_verdict(json_price, meta_prices, json_complete)
+    }
+
+async def scrape_static(url):
+    """Fast path: plain GET of server-rendered HTML, no browser.
+
+    Returns the page data only when structured data settles the price.
+    """
+    try:
+        async with HTTP_GATE:
+            r = await http_client.get(url, headers={"User-Agent": random.choice(USER_AGENTS)})
+        if r.status_code != 200 or 'html' not in r.headers.get('content-type', ''): return None
+        data = extract_fields(BeautifulSoup(r.text, 'lxml'))
+    except Exception: return None
+
+    if data['price'] is None:
+        # Real HTML that still can't settle a price: the host renders
+        # client-side, so the rest of the patrol goes straight to the browser
+        JS_HOSTS.add(urlparse(url).netloc)
+        return None
+    data['etag'], data['last_modified'] = r.headers.get('etag'), r.headers.get('last-modified')
+    return data
 
+async def scrape_page(ctx, url):
+    """Loads one URL in the browser and runs every extractor over it."""
+    page = None
+    try:
+        page = await ctx.new_page()
+        response = await page.goto(url, wait_until="domcontentloaded")
+        validators = response.headers if response else {}
+
+        # Wake up as soon as a real price has rendered instead of a fixed sleep
+        try: await page.wait_for_function(PRICE_READY_JS, polling=250, timeout=8000)
+        except PlaywrightTimeoutError: pass
+
+        # Expanders: fired together, so misses cost one timeout, not four
+        await asyncio.gather(*(try_click(page, key) for key in ["spec", "dimen", "desc", "more"]))
+
+        html = await page.content()
+        data = extract_fields(BeautifulSoup(html, 'lxml'))
+
+        # --- PRICE VERDICT ---
+        # The rendered body text is only pulled over CDP when
+        # structured data can't settle the price on its own.
+        if data['price'] is None:
+            # Truncated in the browser: only the price-bearing head crosses CDP
+            body_text = await page.evaluate(
+                "n => document.body.innerText.slice(0, n)", BODY_TEXT_LIMIT
+            )
+            data['price'] = get_price_verdict(data['json_price'], data['meta_prices'], body_text)
+            # A rendered price can move while the HTML shell (and so its
+            # validators) stays put: never let a 304 vouch for it
+            validators = {}
+
+        data['etag'], data['last_modified'] = validators.get('etag'), validators.get('last-modified')
+        return data
+    finally:
+        if page: await page.close()
+
+async def process_product(pool, rows):
+    """Checks one URL and fans the result out to every source watching it."""
+    # One page per host at a time: bursts trip retailer WAFs into 429s
+    host = urlparse(rows[0]['url']).netloc
+    async with HOST_GATES[host]:
+        # Pace repeat hits on a host; jitter keeps queued workers out of lockstep
+        loop = asyncio.get_running_loop()
+        wait = HOST_LAST_HIT.get(host, 0) + HOST_INTERVAL - loop.time()
+        await asyncio.sleep(max(0, wait) + random.uniform(0, HOST_JITTER))
         try:
-            page = await browser.new_page(user_agent=random.choice(USER_AGENTS))
-            await page.goto(url, timeout=60000, wait_until="domcontentloaded")
-            await asyncio.sleep(4) 
-
-            # Expanders
-            for key in ["spec", "dimen", "desc", "more"]:
-                try: await page.locator(f"text=/{key}/i").first.click(timeout=500)
-                except: pass
-
-            html = await page.content()
-            body_text = await page.inner_text("body")
-            soup = BeautifulSoup(html, 'html.parser')
-
-            # --- EXTRACTION ---
-            
-            json_data = extract_json_ld(soup)
-            
-            name = json_data.get('name')
-            if not name:
-                t = soup.find("meta", property="og:title")
-                name = t.get("content") if t else soup.title.string
-
-            desc = get_best_description(soup, name, json_data.get('description'))
-
-            img_url = json_data.get('image_url')
-            if not img_url:
-                i = soup.find("meta", property="og:image")
-                img_url = i.get("content") if i else None
-
-            # --- PRICE VERDICT ---
-            price = get_price_verdict(soup, json_data.get('price'), body_text)
-
-            # --- SAVE ---
-            update_data = {
-                "name": (name or "Unknown")[:255],
-                "description": desc,
-                "updated_at": datetime.now().isoformat()
-            }
-            if img_url: update_data['image_url'] = img_url
-            if price: update_data['price'] = price
-
-            supabase.table("products").update(update_data).eq("id", pid).execute()
-
-            if price:
-                supabase.table("product_sources").update({
-                    "last_price": price, "last_checked": "now()"
-                }).eq("id", source_id).execute()
-                supabase.table("price_history").insert({
-                    "product_id": pid, "price": price
-                }).execute()
-            else:
-                logger.warning("   ⚠️ No valid price found.")
-
-            await page.close()
-
+            return await check_url(pool, rows)
+        finally:
+            HOST_LAST_HIT[host] = loop.time()
+
+async def check_url(pool, rows):
+    url = rows[0]['url']
+
+    # --- CONDITIONAL SKIP ---
+    # A 304 means the page (and so the price) hasn't moved: skip the browser
+    if await is_unchanged(rows):
+        logger.info(f"💤 Unchanged (304): {url}")
+        return [{"source": mark_checked(r)} for r in rows]
+
+    # --- STATIC FIRST ---
+    # Server-rendered structured data needs no browser at all
+    host = urlparse(url).netloc
+    if host not in JS_HOSTS:
+        data = await scrape_static(url)
+        if data:
+            logger.info(f"⚡ Static: {url}")
+            return [build_writes(r, data) for r in rows]
+
+    # Borrow a warm context; the pool size doubles as the concurrency cap
+    ctx = await pool.get()
+    try:
+        logger.info(f"🔎 Checking: {url}" + (f" ({len(rows)} sources)" if len(rows) > 1 else ""))
+        data = await scrape_page(ctx, url)
+    except Exception as e:
+        logger.error(f"   ⚠️ Scrape Error: {e}")
+        # Still counts as a visit, so dead pages rotate to the back of the patrol
+        return [{"source": mark_checked(r)} for r in rows]
+    finally:
+        pool.put_nowait(ctx)
+
+    if not data['price']:
+        logger.warning("   ⚠️ No valid price found.")
+    return [build_writes(r, data) for r in rows]
+
+# --- 5. BATCH WRITER ---
+
+async def link_orphans(sources):
+    """Auto-Linker: gives every orphaned source a placeholder product in bulk."""
+    orphans = [r for r in sources if r['product_id'] is None or r['product_id'] == "None"]
+    if not orphans: return sources
+
+    try:
+        new_prods = await run_db(supabase.table("products").insert([
+            {"name": "Scanning...", "is_approved": False, "category": "Uncategorized"}
+            for _ in orphans
+        ]))
+        # RETURNING preserves the order of the inserted rows
+        for row, prod in zip(orphans, new_prods.data): row['product_id'] = prod['id']
+        await run_db(supabase.table("product_sources").upsert([
+            {"id": r['id'], "url": r['url'], "product_id": r['product_id']} for r in orphans
+        ]))
+        logger.info(f"🔗 Linked {len(orphans)} orphaned sources.")
+        return sources
+    except Exception as e:
+        logger.error(f"   ❌ DB Fix Failed: {e}")
+        orphan_ids = {r['id'] for r in orphans}
+        return [r for r in sources if r['id'] not in orphan_ids]
+
+async def save_results(results):
+    """Flushes a batch of checks in one round-trip per table.
+
+    Takes (url, outcome) pairs; a crashed check is logged and skipped.
+    """
+    products, sources, history = {}, [], []
+    for url, batch in results:
+        if isinstance(batch, BaseException):
+            logger.error(f"❌ Check Crashed: {url}: {batch!r}")
+            continue
+        for r in batch:
+            # Keyed by id: ON CONFLICT cannot touch the same row twice per statement
+            if 'product' in r: products[r['product']['id']] = r['product']
+            if 'source' in r: sources.append(r['source'])
+            if 'history' in r: history.append(r['history'])
+
+    writes = [
+        ("products", "upsert", list(products.values())),
+        ("product_sources", "upsert", sources),
+        ("price_history", "insert", history),
+    ]
+    failed = False
+    for table, method, rows in writes:
+        # Each table on its own: one failed upsert must not cost the others
+        try:
+            # Multi-row statements, capped so huge patrols stay under request limits
+            for i in range(0, len(rows), WRITE_CHUNK):
+                query = getattr(supabase.table(table), method)(rows[i:i + WRITE_CHUNK])
+                await run_db(query)
         except Exception as e:
-            logger.error(f"   ⚠️ Scrape Error: {e}")
+            failed = True
+            logger.error(f"❌ Batch Save Failed ({table}): {e}")
+    if not failed: logger.info(f"💾 Saved {len(products)} products, {len(history)} price points.")
+
+async def check_group(pool, url, rows):
+    """Runs one URL group, handing back (url, writes or the exception raised)."""
+    try: return url, await process_product(pool, rows)
+    except Exception as e: return url, e
+
+async def prepare_context(ctx):
+    """Shared setup for every context a worker can borrow."""
+    ctx.set_default_navigation_timeout(NAV_TIMEOUT)
+    await ctx.route("**/*", block_heavy_assets)
+
+async def open_contexts(p):
+    """Returns CONCURRENCY context slots and the object that owns them."""
+    if BROWSER_PROFILE_DIR:
+        # A persistent profile is a single context: every worker shares it
+        ctx = await p.chromium.launch_persistent_context(
+            BROWSER_PROFILE_DIR, headless=True,
+            user_agent=random.choice(USER_AGENTS),
+            args=[f"--disk-cache-size={PROFILE_CACHE_BYTES}"]
+        )
+        await prepare_context(ctx)
+        return [ctx] * CONCURRENCY, ctx
+
+    # Context Pool: one warm context per worker, reused across URLs.
+    # Over CDP, closing the browser only drops our contexts and disconnects.
+    if BROWSER_CDP_URL: browser = await p.chromium.connect_over_cdp(BROWSER_CDP_URL)
+    else: browser = await p.chromium.launch(headless=True)
+    contexts = []
+    for _ in range(CONCURRENCY):
+        ctx = await browser.new_context(user_agent=random.choice(USER_AGENTS))
+        await prepare_context(ctx)
+        contexts.append(ctx)
+    return contexts, browser
+
+async def fetch_sources():
+    """Pages through the patrol list; one response is capped server-side."""
+    sources = []
+    while True:
+        size = READ_PAGE
+        if PATROL_LIMIT: size = min(size, PATROL_LIMIT - len(sources))
+        if size <= 0: break
+
+        # Only the product columns the writer diffs against. Source columns stay
+        # '*' so the optional validator columns are picked up when present.
+        # Stalest first, so a capped run always works the most overdue URLs;
+        # id breaks ties so pages never overlap.
+        start = len(sources)
+        query = supabase.table("product_sources").select(
+            "*, products(name, description, image_url, price)"
+        ).order("last_checked", nullsfirst=True).order("id").range(start, start + size - 1)
+        page = (await run_db(query)).data
+        # A short page may just mean a lower server cap: only an empty one ends the list
+        if not page: break
+        sources += page
+    return sources
 
 async def main():
     logger.info("📡 Fetching patrol list...")
-    response = supabase.table("product_sources").select("*, products(*)").execute()
-    sources = response.data
+    sources = await fetch_sources()
     
     if not sources: return
 
-    sem = asyncio.Semaphore(CONCURRENCY)
-    
+    sources = await link_orphans(sources)
+
     async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        tasks = [process_product(sem, browser, row) for row in sources]
-        await asyncio.gather(*tasks)
-        await browser.close()
+        slots, owner = await open_contexts(p)
+        pool = asyncio.Queue()
+        for ctx in slots: pool.put_nowait(ctx)
+
+        # One scrape per URL, however many sources watch it
+        by_url = defaultdict(list)
+        for row in sources: by_url[row['url']].append(row)
+
+        # Flushed as checks land: a killed or crashed run keeps what it finished
+        results, queued = [], 0
+        try:
+            tasks = [check_group(pool, url, rows) for url, rows in by_url.items()]
+            for done in asyncio.as_completed(tasks):
+                url, batch = await done
+                results.append((url, batch))
+                if isinstance(batch, list): queued += len(batch)
+                if queued >= WRITE_CHUNK:
+                    await save_results(results)
+                    results, queued = [], 0
+        finally:
+            if results: await save_results(results)
+            # Closing the owner tears down every context it created
+            try: await owner.close()
+            finally: await http_client.aclose()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # libuv loop when available; same coroutine either way
+    (uvloop.run if uvloop else asyncio.run)(main())